@@ -1,40 +1,761 @@
 import asyncio
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+import re
+import time
+import logging
+import logging.handlers
+from queue import SimpleQueue
+import sqlite3
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from urllib.parse import quote_plus
+from collections import OrderedDict, deque
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
+from selectolax.lexbor import LexborHTMLParser
+from aiogram import Bot, Dispatcher, Router, F, types
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
-from playwright.async_api import async_playwright
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from playwright.async_api import async_playwright, Playwright, Browser, BrowserContext, Page, Route
+from playwright.async_api import Error as PlaywrightError
 import os
 
 TOKEN = os.environ.get("TOKEN")
-bot = Bot(token=TOKEN)
+# адрес локального telegram-bot-api (например http://127.0.0.1:8081), если он поднят рядом с ботом
+TELEGRAM_API_SERVER = os.environ.get("TELEGRAM_API_SERVER")
+
+if TELEGRAM_API_SERVER:
+    bot = Bot(
+        token=TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+    )
+else:
+    bot = Bot(token=TOKEN)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-user_queries = {}
-user_logs = {}  # лог показанных картинок
+ERROR_LOG_PATH = os.environ.get("ERROR_LOG_PATH", "bot_errors.log")
 
 
-async def search_pinterest(query: str, limit: int = 50):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        page = await browser.new_page()
+def setup_logging() -> logging.handlers.QueueListener:
+    # обработчики пишут в консоль и файл из отдельного потока — event loop не ждёт диск
+    log_queue = SimpleQueue()
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
 
-        await page.goto(
-            f"https://www.pinterest.com/search/pins/?q={query.replace(' ', '%20')}",
-            timeout=60000
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    errors_file = logging.FileHandler(ERROR_LOG_PATH, encoding="utf-8")
+    errors_file.setLevel(logging.ERROR)
+    errors_file.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, console, errors_file, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Telegram ограничивает бота ~30 сообщениями в секунду на всех пользователей
+send_limiter = AsyncLimiter(25, 1.0)
+# а в один чат одновременно шлём не больше PER_CHAT_SENDS фото, чтобы не упереться в лимит чата
+PER_CHAT_SENDS = 3
+SEND_ATTEMPTS = 3  # сколько раз пробуем отправить после RetryAfter от Telegram
+_chat_send_sems: dict[int, list] = {}  # chat_id -> [семафор, сколько отправок его держат или ждут]
+
+# по одному замку на чат: внутри чата действия идут по порядку, разные чаты — параллельно
+_chat_locks: dict[int, list] = {}  # chat_id -> [замок, сколько задач его держат или ждут]
+_background_tasks: set[asyncio.Task] = set()
+
+
+@asynccontextmanager
+async def _held(registry: dict, key: int, factory):
+    # примитив живёт в словаре, только пока его держат или ждут, — иначе словарь растёт с каждым чатом
+    entry = registry.get(key)
+    if entry is None:
+        entry = registry[key] = [factory(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del registry[key]
+
+
+def _lock(user_id: int):
+    return _held(_chat_locks, user_id, asyncio.Lock)
+
+
+def _log_task_error(task: asyncio.Task):
+    # без этого ошибка фоновой задачи всплыла бы только при сборке мусора, без нормального трейсбека
+    if not task.cancelled() and task.exception():
+        logging.error("background task %s failed", task.get_name(), exc_info=task.exception())
+
+
+def _spawn(coro):
+    # держим ссылку на задачу, иначе её может собрать GC до завершения
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_task_error)
+    return task
+
+
+@dataclass(slots=True)
+class UserState:
+    query: str
+    images: list  # всё найденное по запросу, для повторного круга
+    queue: deque
+    seen: set
+    bookmark: str | None = None  # курсор следующей страницы JSON API
+    page: Page | None = None  # открытая вкладка с выдачей для догрузки прокруткой
+    page_ctx: BrowserContext | None = None  # контекст из пула, занятый этой вкладкой до её закрытия
+    page_used: float = 0.0
+    last_shown: float = field(default_factory=time.monotonic)  # когда пользователю последний раз отправляли блок
+    scrolls: int = 0  # на сколько экранов прокручена текущая вкладка
+    depth: int = 0  # самая глубокая прокрутка за сессию — до неё докручиваем вкладку после закрытия
+    fetch_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    fetch_exhausted: bool = False
+    queue_ready: asyncio.Event = field(default_factory=asyncio.Event)  # загрузчик добавил картинки в очередь
+    refill: asyncio.Event = field(default_factory=asyncio.Event)  # очередь просела — загрузчику пора за новой порцией
+    fetcher: asyncio.Task | None = None
+
+
+user_queries: dict[int, UserState] = {}
+
+# клавиатура неизменна — собираем её один раз, а не на каждое сообщение
+MORE_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="Показать ещё", callback_data="more")]]
+)
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
+VIEWPORT = {"width": 1280, "height": 2000}
+CONTEXT_POOL_SIZE = int(os.environ.get("CONTEXT_POOL_SIZE", 4))
+# после стольких выдач контекст пересоздаётся, чтобы Chromium не разбухал со временем
+CONTEXT_RECYCLE_AFTER = int(os.environ.get("CONTEXT_RECYCLE_AFTER", 100))
+# файл storage_state (playwright codegen --save-storage) с принятыми на Pinterest cookie —
+# каждый контекст пула стартует с ним и не упирается в баннер согласия
+STORAGE_STATE = os.environ.get("PINTEREST_STORAGE_STATE")
+CHROMIUM_ARGS = [
+    "--disable-dev-shm-usage",
+    "--no-sandbox",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--disable-background-networking",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+]
+BLOCKED_RESOURCES = {"image", "media", "font", "stylesheet"}  # нам нужны только URL, не сами картинки
+BLOCK_SIZE = 5  # сколько картинок отправляем за раз
+QUEUE_TARGET = 3 * BLOCK_SIZE  # столько картинок фоновый загрузчик старается держать в очереди
+SCROLLS_PER_FETCH = 3
+# за одну догрузку возвращаемся не больше чем на столько экранов — остальное догоним следующими порциями,
+# чтобы глубокая сессия не держала fetch_lock и контекст минутами
+MAX_RESTORE_SCROLLS = 12
+SCROLL_PAUSE = 1.5  # секунд между прокрутками, чтобы Pinterest успел подгрузить пины
+FETCH_WAIT_TIMEOUT = 5.0  # сколько ждём догрузку, если очередь почти пуста
+MIN_HTTP_RESULTS = 5  # если по HTTP нашли меньше — идём через браузер
+SEARCH_CACHE_TTL = 600  # секунд
+SEARCH_CACHE_SIZE = 512
+PAGE_CACHE_TTL = 60  # секунд держим ответ API на конкретную страницу (query, bookmark)
+PAGE_CACHE_SIZE = 512
+URL_CHECK_TTL = 600  # секунд помним, что ссылка живая/мёртвая
+URL_CHECK_CACHE_SIZE = 4096
+URL_CHECK_TIMEOUT = aiohttp.ClientTimeout(total=2)
+DB_PATH = os.environ.get("DB_PATH", "bot_state.db")
+DB_SWEEP_INTERVAL = 600  # секунд между чистками протухшего кэша в БД
+PAGE_IDLE_TIMEOUT = 600  # вкладку, которую столько не прокручивали, закрываем; сессию без показов — выгружаем
+
+HTTP_HEADERS = {
+    "User-Agent": USER_AGENT,
+    "Accept-Language": "en",
+}
+PINTEREST_SEARCH_URL = "https://www.pinterest.com/search/pins/"
+PINTEREST_RESOURCE_URL = "https://www.pinterest.com/resource/BaseSearchResource/get/"
+API_HEADERS = {
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+    "X-Requested-With": "XMLHttpRequest",
+    "X-Pinterest-PWS-Handler": "www/search/[scope].js",
+}
+# Pinterest отдаёт первую выдачу пинов прямо в HTML, в JSON внутри <script>
+PWS_SCRIPT_SELECTOR = "script#__PWS_DATA__, script#__PWS_INITIAL_PROPS__"
+_SRCSET_RE = re.compile(r'(https?://\S+)\s+(\d+)[wx]')
+# размеры картинки пина в порядке предпочтения
+_IMG_KEYS = ("orig", "originals", "736x", "474x")
+# аватарки, иконки профилей и прочие мелкие картинки — не пины
+_REJECT_RE = re.compile(r'60x60|75x75|avatar|profile|user')
+# превью ленты меняем на крупный вариант того же пина
+_THUMB_RE = re.compile(r'/(?:236|474)x/')
+
+
+async def _block_heavy_resources(route: Route):
+    if route.request.resource_type in BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+# пул заранее созданных контекстов: ограничивает число одновременных вкладок Chromium
+class ContextPool:
+    def __init__(self, browser: Browser, size: int, recycle_after: int):
+        self._browser = browser
+        self._size = size
+        self._recycle_after = recycle_after
+        self._q: asyncio.Queue[BrowserContext] = asyncio.Queue()
+        self._served: dict[BrowserContext, int] = {}
+        self._warmed = False
+        self._warm_lock = asyncio.Lock()
+        self._storage_state = None
+        self._seed_cookies = []
+        if STORAGE_STATE and os.path.exists(STORAGE_STATE):
+            self._storage_state = STORAGE_STATE
+            with open(STORAGE_STATE, "rb") as f:
+                self._seed_cookies = orjson.loads(f.read()).get("cookies", [])
+
+    async def _new_context(self) -> BrowserContext:
+        ctx = await self._browser.new_context(
+            user_agent=USER_AGENT,
+            viewport=VIEWPORT,
+            storage_state=self._storage_state
         )
+        await ctx.route("**/*", _block_heavy_resources)
+        self._served[ctx] = 0
+        return ctx
 
-        await page.wait_for_selector("img[srcset]", timeout=20000)
+    async def _warm(self):
+        async with self._warm_lock:
+            if self._warmed:
+                return
+            for _ in range(self._size):
+                self._q.put_nowait(await self._new_context())
+            self._warmed = True
+
+    async def acquire_nowait(self) -> BrowserContext | None:
+        # None — все контексты заняты; ждать освобождения — забота вызывающего
+        if not self._warmed:
+            await self._warm()
+        if self._q.empty():
+            return None
+        ctx = self._q.get_nowait()
+        self._served[ctx] += 1
+        return ctx
+
+    async def release(self, ctx: BrowserContext):
+        # отмена вызывающего (например, загрузчика при смене запроса) не должна терять контекст —
+        # иначе пул усыхает навсегда; возврат доводим до конца в отдельной задаче
+        await asyncio.shield(self._release(ctx))
+
+    async def _release(self, ctx: BrowserContext):
+        # контекст возвращается без вкладок: их закрывает тот, кто его брал
+        if self._served[ctx] < self._recycle_after:
+            try:
+                await ctx.clear_cookies()
+                if self._seed_cookies:
+                    await ctx.add_cookies(self._seed_cookies)
+                self._q.put_nowait(ctx)
+                _context_freeable.set()
+                return
+            except PlaywrightError as e:
+                logging.warning("context reset failed, recreating it: %s", e)
+
+        del self._served[ctx]
+        try:
+            await ctx.close()
+        except PlaywrightError:
+            pass
+        self._q.put_nowait(await self._new_context())
+        _context_freeable.set()
+
+    async def close(self):
+        while not self._q.empty():
+            await self._q.get_nowait().close()
+        self._served.clear()
+
+
+@asynccontextmanager
+async def acquire_context():
+    ctx = await acquire_free_context()
+    try:
+        yield ctx
+    finally:
+        await POOL.release(ctx)
 
-        # собираем всё
-        srcsets = await page.eval_on_selector_all(
-            "img[srcset]",
-            "imgs => imgs.map(img => img.srcset.split(', ').map(s => s.split(' ')[0]).pop())"
+
+# один Playwright и один Chromium на весь процесс, запускаются в main()
+PW: Playwright | None = None
+BROWSER: Browser | None = None
+POOL: ContextPool | None = None
+# одна HTTP-сессия на процесс — keep-alive соединения с pinterest.com переиспользуются
+_session: aiohttp.ClientSession | None = None
+
+
+# словарь с временем жизни записей и вытеснением по LRU; попадание освежает запись
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if time.monotonic() - item[0] >= self._ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item[1]
+
+    def put(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+
+# кэш выдачи: нормализованный запрос -> (список URL, bookmark)
+_search_cache = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE)
+# страницы JSON API: (запрос, bookmark) -> (список URL, следующий bookmark)
+_page_cache = TTLCache(PAGE_CACHE_TTL, PAGE_CACHE_SIZE)
+# результаты HEAD-проверок: url -> живая ли ссылка
+_url_checks = TTLCache(URL_CHECK_TTL, URL_CHECK_CACHE_SIZE)
+
+# SQLite с WAL: кэш выдачи, история запросов и показанные картинки переживают рестарт.
+# Все обращения идут через asyncio.to_thread, чтобы не блокировать event loop.
+_db: sqlite3.Connection | None = None
+_db_lock = threading.Lock()
+
+
+def _db_open():
+    global _db
+    _db = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    _db.execute("PRAGMA journal_mode=WAL")
+    _db.execute("PRAGMA synchronous=NORMAL")
+    _db.execute("CREATE TABLE IF NOT EXISTS kv_cache (query TEXT PRIMARY KEY, urls BLOB, ts INTEGER)")
+    _db.execute("CREATE TABLE IF NOT EXISTS user_history (user_id INTEGER, ts INTEGER, query TEXT)")
+    _db.execute("CREATE TABLE IF NOT EXISTS user_shown (user_id INTEGER, url_hash INTEGER)")
+    _db.execute("CREATE INDEX IF NOT EXISTS user_history_idx ON user_history (user_id, ts)")
+    try:
+        _db.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_shown_idx ON user_shown (user_id, url_hash)")
+    except sqlite3.IntegrityError:
+        # в старой базе могли накопиться дубли — чистим и создаём индекс заново
+        _db.execute(
+            "DELETE FROM user_shown WHERE rowid NOT IN "
+            "(SELECT MIN(rowid) FROM user_shown GROUP BY user_id, url_hash)"
         )
+        _db.execute("CREATE UNIQUE INDEX user_shown_idx ON user_shown (user_id, url_hash)")
+    try:
+        _db.execute("ALTER TABLE kv_cache ADD COLUMN bookmark TEXT")
+    except sqlite3.OperationalError:
+        pass  # колонка уже есть
+
+
+def _db_close():
+    global _db
+    # поток to_thread может ещё дописывать — закрываем под тем же замком
+    with _db_lock:
+        if _db:
+            _db.close()
+            _db = None
+
+
+def _db_get_cached(query: str):
+    with _db_lock:
+        row = _db.execute(
+            "SELECT urls, bookmark FROM kv_cache WHERE query = ? AND ts >= ?",
+            (query, int(time.time()) - SEARCH_CACHE_TTL)
+        ).fetchone()
+    return (orjson.loads(row[0]), row[1]) if row else None
+
+
+def _db_put_cached(query: str, urls: list, bookmark: str | None):
+    with _db_lock:
+        _db.execute(
+            "INSERT OR REPLACE INTO kv_cache (query, urls, ts, bookmark) VALUES (?, ?, ?, ?)",
+            (query, orjson.dumps(urls), int(time.time()), bookmark)
+        )
+
+
+def _db_add_history(user_id: int, query: str):
+    with _db_lock:
+        _db.execute(
+            "INSERT INTO user_history (user_id, ts, query) VALUES (?, ?, ?)",
+            (user_id, int(time.time()), query)
+        )
+
+
+def _db_last_query(user_id: int):
+    with _db_lock:
+        row = _db.execute(
+            "SELECT query FROM user_history WHERE user_id = ? ORDER BY ts DESC, rowid DESC LIMIT 1",
+            (user_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def _url_hash(url: str) -> int:
+    # стабильный между перезапусками 64-битный хэш (встроенный hash() рандомизирован)
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+def _db_add_shown(user_id: int, urls: list):
+    with _db_lock:
+        _db.executemany(
+            "INSERT OR IGNORE INTO user_shown (user_id, url_hash) VALUES (?, ?)",
+            [(user_id, _url_hash(u)) for u in urls]
+        )
+
+
+def _db_filter_unseen(user_id: int, urls: list):
+    # оставляем только то, что пользователь ещё не видел, в том числе до перезапуска бота
+    if not urls:
+        return []
+    hashes = {u: _url_hash(u) for u in urls}
+    placeholders = ",".join("?" * len(hashes))
+    with _db_lock:
+        rows = _db.execute(
+            f"SELECT url_hash FROM user_shown WHERE user_id = ? AND url_hash IN ({placeholders})",
+            (user_id, *hashes.values())
+        ).fetchall()
+    shown = {r[0] for r in rows}
+    return [u for u in urls if hashes[u] not in shown]
+
+
+def _db_sweep():
+    with _db_lock:
+        _db.execute("DELETE FROM kv_cache WHERE ts < ?", (int(time.time()) - SEARCH_CACHE_TTL,))
+
+
+async def sweep_db_periodically():
+    while True:
+        await asyncio.sleep(DB_SWEEP_INTERVAL)
+        try:
+            await asyncio.to_thread(_db_sweep)
+        except sqlite3.Error as e:
+            logging.error("db sweep failed: %s", e)
+
+
+# выставляется, когда контекст вернулся в пул или чья-то догрузка закончилась и её вкладку можно закрыть
+_context_freeable = asyncio.Event()
+
+# запросы, которые прямо сейчас скрейпятся: повторные вызовы ждут тот же результат
+_inflight: dict[str, asyncio.Future] = {}
+
+
+async def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers=HTTP_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(
+                limit=50,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def start_browser():
+    global PW, BROWSER, POOL
+    PW = await async_playwright().start()
+    BROWSER = await PW.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+    POOL = ContextPool(BROWSER, CONTEXT_POOL_SIZE, CONTEXT_RECYCLE_AFTER)
+
+
+async def stop_browser():
+    global PW, BROWSER, POOL
+    if POOL:
+        await POOL.close()
+        POOL = None
+    if BROWSER:
+        await BROWSER.close()
+        BROWSER = None
+    if PW:
+        await PW.stop()
+        PW = None
+
+
+def search_url(query: str) -> str:
+    # quote_plus корректно кодирует &, #, / и кириллицу, а не только пробелы
+    return f"{PINTEREST_SEARCH_URL}?q={quote_plus(query)}"
+
+
+async def open_search_page(ctx: BrowserContext, query: str) -> Page:
+    page = await ctx.new_page()
+    try:
+        await page.goto(
+            search_url(query),
+            timeout=60000,
+            wait_until="domcontentloaded"
+        )
+        await page.wait_for_selector("img[srcset]", timeout=20000)
+    except BaseException:
+        await page.close()
+        raise
+    return page
+
+
+# прокрутка и сбор картинок целиком на стороне страницы — один вызов CDP вместо цикла из Python;
+# наружу отдаём только сырые srcset/src картинок с CDN пинов, разбираем их уже в Python
+_SCROLL_AND_COLLECT_JS = """async ([scrolls, pauseMs]) => {
+    for (let i = 0; i < scrolls; i++) {
+        window.scrollBy(0, window.innerHeight);
+        await new Promise(r => setTimeout(r, pauseMs));
+    }
+    return Array.from(
+        document.querySelectorAll("img[src*='pinimg.com']"),
+        img => [img.srcset, img.src]
+    );
+}"""
+
+
+async def scroll_and_extract(page: Page, scrolls: int = 0):
+    pairs = await page.evaluate(_SCROLL_AND_COLLECT_JS, [scrolls, int(SCROLL_PAUSE * 1000)])
+
+    urls = [clean_image_url(pick_largest(srcset) or src) for srcset, src in pairs]
+    return list(dict.fromkeys(u for u in urls if u))  # убираем дубли, сохраняя порядок
+
+
+async def fetch_images_from_pinterest(ctx: BrowserContext, query: str, scrolls: int = 0):
+    page = await open_search_page(ctx, query)
+    try:
+        return await scroll_and_extract(page, scrolls)
+    finally:
+        await page.close()
+
 
-        await browser.close()
-        return srcsets
+# каждая прокрутка заново отдаёт все картинки страницы — повторные srcset/URL не гоняем через regex
+@lru_cache(maxsize=4096)
+def pick_largest(srcset: str):
+    # из "url1 236w, url2 474w, ..." берём вариант с наибольшей шириной
+    candidates = _SRCSET_RE.findall(srcset or "")
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: int(c[1]))[0]
+
+
+@lru_cache(maxsize=4096)
+def clean_image_url(url: str):
+    if not url or _REJECT_RE.search(url):
+        return None
+    return _THUMB_RE.sub("/736x/", url)
+
+
+def _pin_image_url(images) -> str | None:
+    # самый крупный доступный размер из images пина
+    if not isinstance(images, dict):
+        return None
+    for key in _IMG_KEYS:
+        img = images.get(key)
+        if isinstance(img, dict) and img.get("url"):
+            return img["url"]
+    return None
+
+
+def _collect_pin_urls(node, out: list):
+    # обходим JSON и достаём картинку каждого пина
+    if isinstance(node, dict):
+        url = _pin_image_url(node.get("images"))
+        if url:
+            out.append(url)
+        for v in node.values():
+            _collect_pin_urls(v, out)
+    elif isinstance(node, list):
+        for v in node:
+            _collect_pin_urls(v, out)
+
+
+def parse_html_images(html: str):
+    urls = []
+    tree = LexborHTMLParser(html)
+    script = tree.css_first(PWS_SCRIPT_SELECTOR)
+    if script:
+        try:
+            _collect_pin_urls(orjson.loads(script.text()), urls)
+        except orjson.JSONDecodeError:
+            pass
+
+    # JSON не нашёлся — берём картинки прямо из разметки
+    if not urls:
+        for node in tree.css("img[srcset]"):
+            url = clean_image_url(pick_largest(node.attributes.get("srcset") or ""))
+            if url:
+                urls.append(url)
+
+    return list(dict.fromkeys(urls))  # убираем дубли, сохраняя порядок
+
+
+@lru_cache(maxsize=1024)
+def _api_query_parts(query: str):
+    # неизменная между страницами часть параметров: кодируем один раз на запрос
+    return f"/search/pins/?q={quote_plus(query)}", orjson.dumps(query).decode()
+
+
+_logged_once: set[str] = set()
+
+
+def _log_once(message_id: str, level: int, msg: str, *args):
+    # диагностика, которой достаточно одной строки на процесс, а не строки на каждый запрос
+    if message_id not in _logged_once:
+        _logged_once.add(message_id)
+        logging.log(level, msg, *args)
+
+
+async def fetch_images_from_pinterest_api(query: str, bookmark: str | None = None):
+    # JSON-ресурс Pinterest отдаёт пины страницами; bookmark — курсор на следующую.
+    # None — запрос не удался (курсор стоит сохранить), ([], None) — страниц больше нет
+    key = (query, bookmark)
+    cached = _page_cache.get(key)
+    if cached:
+        return list(cached[0]), cached[1]
+
+    source_url, query_json = _api_query_parts(query)
+    bookmarks = f',"bookmarks":[{orjson.dumps(bookmark).decode()}]' if bookmark else ""
+    params = {
+        "source_url": source_url,
+        "data": f'{{"options":{{"query":{query_json},"scope":"pins","page_size":25{bookmarks}}},"context":{{}}}}',
+    }
+    try:
+        session = await get_session()
+        async with session.get(PINTEREST_RESOURCE_URL, params=params, headers=API_HEADERS) as response:
+            if response.status != 200:
+                return None
+            # Accept-Encoding выставляет сам aiohttp (br — только если установлен Brotli); проверяем, что сжатие работает
+            _log_once(
+                "content-encoding", logging.INFO,
+                "pinterest responses use Content-Encoding: %s", response.headers.get("Content-Encoding", "none")
+            )
+            data = orjson.loads(await response.read())
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+        return None
+
+    resource = data.get("resource_response") if isinstance(data, dict) else None
+    results = resource.get("data") if isinstance(resource, dict) else None
+    results = results.get("results") if isinstance(results, dict) else None
+    if not isinstance(results, list):
+        _log_once("malformed-payload", logging.WARNING, "unexpected pinterest api payload, skipping: %.300r", data)
+        return None
+
+    urls = []
+    for pin in results:
+        if not isinstance(pin, dict):
+            _log_once("malformed-payload", logging.WARNING, "unexpected pinterest api payload, skipping: %.300r", pin)
+            continue
+        url = _pin_image_url(pin.get("images"))
+        if url:
+            urls.append(url)
+
+    next_bookmark = resource.get("bookmark")
+    if not isinstance(next_bookmark, str) or next_bookmark == "-end-":  # так Pinterest помечает последнюю страницу
+        next_bookmark = None
+    urls = list(dict.fromkeys(urls))
+
+    if urls:
+        _page_cache.put(key, (urls, next_bookmark))
+    return list(urls), next_bookmark
+
+
+async def fetch_images_from_pinterest_html(query: str):
+    try:
+        session = await get_session()
+        # кодирование запроса отдаём aiohttp/yarl
+        async with session.get(PINTEREST_SEARCH_URL, params={"q": query}) as response:
+            if response.status != 200:
+                return []
+            html = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return []
+    return parse_html_images(html)
+
+
+def normalize_query(query: str) -> str:
+    # "Cat " и "cat" должны попадать в одну запись кэша
+    return " ".join(query.lower().split())
+
+
+async def _search_pinterest_uncached(query: str):
+    # быстрый путь: JSON-ресурс Pinterest, без браузера и с курсором на следующие страницы
+    result = await fetch_images_from_pinterest_api(query)
+    if result and len(result[0]) >= MIN_HTTP_RESULTS:
+        return result
+
+    # если API не ответило — пробуем вытащить пины из HTML выдачи
+    images = await fetch_images_from_pinterest_html(query)
+    if len(images) >= MIN_HTTP_RESULTS:
+        return images, None
+
+    # запасной путь: рендерим страницу в Chromium
+    # контекст берём из пула — без затрат на new_context() в горячем пути
+    try:
+        async with acquire_context() as ctx:
+            return await fetch_images_from_pinterest(ctx, query), None
+    except PlaywrightError as e:
+        # по запросу без пинов wait_for_selector падает по таймауту — это пустая выдача, а не сбой бота
+        logging.warning("browser search failed for %r: %s", query, e)
+        return [], None
+
+
+async def search_pinterest(query: str):
+    # возвращает (картинки, bookmark для следующей страницы API или None)
+    key = normalize_query(query)
+    cached = _search_cache.get(key)
+    if cached:
+        return list(cached[0]), cached[1]
+
+    fut = _inflight.get(key)
+    if fut:
+        images, bookmark = await asyncio.shield(fut)
+        return list(images), bookmark
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        cached = await asyncio.to_thread(_db_get_cached, key)
+        if cached:
+            images, bookmark = cached
+        else:
+            images, bookmark = await _search_pinterest_uncached(key)
+            if images:
+                _spawn(asyncio.to_thread(_db_put_cached, key, images, bookmark))
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # помечаем как полученное, если никто больше не ждал
+        raise
+    else:
+        fut.set_result((images, bookmark))
+    finally:
+        _inflight.pop(key, None)
+
+    if images:  # пустую выдачу не кэшируем — вдруг это был сбой
+        _search_cache.put(key, (images, bookmark))
+    return list(images), bookmark
 
 
 @router.message(Command("start"))
@@ -42,68 +763,360 @@ async def start_cmd(message: Message):
     await message.answer("Привет! Введи запрос — я пришлю картинки из Pinterest 📸")
 
 
+async def _send_photo_limited(user_id: int, img: str):
+    async with _held(_chat_send_sems, user_id, lambda: asyncio.Semaphore(PER_CHAT_SENDS)):
+        for attempt in range(SEND_ATTEMPTS):
+            try:
+                async with send_limiter:
+                    return await bot.send_photo(user_id, img, caption=f"🔗 Ссылка: {img}")
+            except TelegramRetryAfter as e:
+                if attempt == SEND_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+
+async def send_photos(user_id: int, images: list):
+    # альбомом — один запрос к Telegram на весь блок (альбом бывает от 2 до 10 фото)
+    if 2 <= len(images) <= 10:
+        media = [InputMediaPhoto(media=img, caption=f"🔗 Ссылка: {img}") for img in images]
+        for _ in range(SEND_ATTEMPTS):
+            try:
+                # лимит Telegram считает каждое фото альбома отдельным сообщением
+                await send_limiter.acquire(len(media))
+                await bot.send_media_group(user_id, media)
+                return list(images)
+            except TelegramRetryAfter as e:
+                logging.warning("send_media_group flood control, retrying in %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramAPIError as e:
+                # одна плохая ссылка или сбой сети валит весь альбом — шлём по одной, чтобы дошли остальные
+                logging.warning("send_media_group failed, sending one by one: %s", e)
+                break
+
+    results = await asyncio.gather(
+        *(_send_photo_limited(user_id, img) for img in images),
+        return_exceptions=True
+    )
+    shown, failed = [], []
+    for img, result in zip(images, results):
+        if isinstance(result, Exception):
+            logging.error("send_photo failed for %s: %s", img, result)
+            failed.append(img)
+        else:
+            shown.append(img)
+
+    # все неудачные ссылки — одним сообщением, а не по запросу на каждую
+    if failed:
+        text = "❌ Не удалось загрузить изображения:\n" if len(failed) > 1 else "❌ Не удалось загрузить изображение:\n"
+        await bot.send_message(user_id, text + "\n".join(failed))
+    return shown
+
+
+async def is_url_alive(url: str) -> bool:
+    cached = _url_checks.get(url)
+    if cached is not None:
+        return cached
+
+    try:
+        session = await get_session()
+        async with session.head(url, allow_redirects=True, timeout=URL_CHECK_TIMEOUT) as response:
+            alive = response.status < 400
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        # таймаут или сбой сети на нашей стороне — не знаем наверняка: пусть Telegram попробует сам, и не кэшируем
+        return True
+
+    _url_checks.put(url, alive)
+    return alive
+
+
+async def close_search_page(state: UserState):
+    page, ctx = state.page, state.page_ctx
+    state.page = state.page_ctx = None
+    try:
+        if page and not page.is_closed():
+            await page.close()
+    finally:
+        # контекст возвращаем в пул только вместе с вкладкой — пока она открыта, он занят
+        if ctx and POOL:
+            await POOL.release(ctx)
+
+
+async def acquire_free_context(user_id: int | None = None) -> BrowserContext:
+    while True:
+        _context_freeable.clear()
+        ctx = await POOL.acquire_nowait()
+        if ctx:
+            return ctx
+
+        # все контексты держат вкладки пользователей — закрываем ту, что дольше всех не прокручивали
+        idle = [
+            s for uid, s in user_queries.items()
+            if uid != user_id and s.page_ctx and not s.fetch_lock.locked()
+        ]
+        if idle:
+            await close_search_page(min(idle, key=lambda s: s.page_used))
+        else:
+            # все вкладки сейчас прокручиваются — ждём возврата контекста или конца чьей-то догрузки
+            await _context_freeable.wait()
+
+
+async def close_idle_sessions_periodically():
+    # пользователь мог уйти, не сменив запрос — не держим его вкладку, загрузчик и найденное вечно;
+    # по «Показать ещё» сессия поднимется заново из user_history
+    while True:
+        await asyncio.sleep(PAGE_IDLE_TIMEOUT / 2)
+        now = time.monotonic()
+        for user_id, state in list(user_queries.items()):
+            if state.fetch_lock.locked() or user_id in _chat_locks:
+                continue
+            if now - state.last_shown > PAGE_IDLE_TIMEOUT:
+                if user_queries.get(user_id) is state:
+                    del user_queries[user_id]
+                state.fetcher.cancel()
+                await asyncio.gather(state.fetcher, return_exceptions=True)
+                await close_search_page(state)
+            elif state.page and now - state.page_used > PAGE_IDLE_TIMEOUT:
+                await close_search_page(state)
+
+
+async def fetcher_loop(user_id: int):
+    # фоновый загрузчик пользователя: держит очередь заполненной, пока отправляются блоки
+    state = user_queries[user_id]
+    while not state.fetch_exhausted:
+        if len(state.queue) >= QUEUE_TARGET:
+            state.refill.clear()
+            await state.refill.wait()
+            continue
+        await search_and_enqueue_more(user_id)
+
+
+async def search_and_enqueue_more(user_id: int):
+    state = user_queries.get(user_id)
+    if not state or state.fetch_lock.locked() or state.fetch_exhausted:
+        return
+
+    # замок, а не флаг: пока одна загрузка идёт, повторные вызовы сразу выходят
+    async with state.fetch_lock:
+        try:
+            found = []
+            # пока есть курсор — листаем JSON API, это на порядок дешевле браузера
+            if state.bookmark:
+                result = await fetch_images_from_pinterest_api(state.query, state.bookmark)
+                # сбой (429, 5xx, таймаут) не должен обнулять курсор — попробуем API в следующий раз
+                if result is not None:
+                    found, state.bookmark = result
+
+            reopened = catching_up = False
+            if not found:
+                # вкладка живёт, пока не сменится запрос: дальше только прокручиваем, без нового goto
+                page = state.page
+                if page is None or page.is_closed():
+                    if state.page_ctx is None:
+                        state.page_ctx = await acquire_free_context(user_id)
+                    page = await open_search_page(state.page_ctx, state.query)
+                    state.page = page
+                    state.scrolls = 0
+                    reopened = True
+
+                # новая вкладка открывается сверху — докручиваем до места, где остановились, порциями
+                scrolls = SCROLLS_PER_FETCH + min(max(state.depth - state.scrolls, 0), MAX_RESTORE_SCROLLS)
+                found = await scroll_and_extract(page, scrolls)
+                state.scrolls += scrolls
+                catching_up = state.scrolls <= state.depth
+                state.depth = max(state.depth, state.scrolls)
+                state.page_used = time.monotonic()
+
+            # один проход: проверка и пополнение seen сразу, без отдельного множества по очереди
+            seen = state.seen
+            new_images = []
+            for img in found:
+                if img not in seen:
+                    seen.add(img)
+                    new_images.append(img)
+
+            if not new_images:
+                if reopened or catching_up:
+                    return  # эту часть выдачи уже показывали — следующая порция прокрутит дальше
+                state.fetch_exhausted = True
+                await close_search_page(state)
+                return
+
+            state.images.extend(new_images)
+            state.queue.extend(await asyncio.to_thread(_db_filter_unseen, user_id, new_images))
+        except Exception as e:
+            logging.error("fetch more failed for %r: %s", state.query, e)
+            state.fetch_exhausted = True
+            await close_search_page(state)
+        finally:
+            state.queue_ready.set()
+            _context_freeable.set()
+
+
 async def send_next_images(user_id: int, call: CallbackQuery = None):
     state = user_queries.get(user_id)
     if not state:
         return
 
-    offset = state["offset"]
-    images = state["images"]
-    next_images = images[offset:offset + 5]
+    state.last_shown = time.monotonic()
+    queue = state.queue
+    # в очереди меньше блока, а выдача ещё не кончилась — будим загрузчик и ждём сигнала, а не крутим по кругу;
+    # одна порция могла дать меньше блока, поэтому ждём до общего дедлайна, а не одно пробуждение
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FETCH_WAIT_TIMEOUT
+    while len(queue) < BLOCK_SIZE and not state.fetch_exhausted:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        state.refill.set()
+        state.queue_ready.clear()
+        try:
+            await asyncio.wait_for(state.queue_ready.wait(), remaining)
+        except asyncio.TimeoutError:
+            break
 
-    if user_id not in user_logs:
-        user_logs[user_id] = []
+    # бесконечный цикл: когда новых картинок больше нет, идём по найденным заново
+    if not queue and state.fetch_exhausted:
+        queue.extend(state.images)
 
-    # отправляем 5 изображений
-    for img in next_images:
-        try:
-            await bot.send_photo(user_id, img, caption=f"🔗 Ссылка: {img}")
-            user_logs[user_id].append(img)
-        except Exception:
-            await bot.send_message(user_id, f"❌ Не удалось загрузить изображение:\n{img}")
+    next_images = [queue.popleft() for _ in range(min(BLOCK_SIZE, len(queue)))]
 
-    state["offset"] += 5
+    # загрузчик догружает следующую порцию, пока отправляются текущие картинки
+    state.refill.set()
 
-    # бесконечный цикл
-    if state["offset"] >= len(images):
-        state["offset"] = 0
+    # битые ссылки отсеиваем дешёвым HEAD, чтобы не ждать таймаута Telegram
+    alive = await asyncio.gather(*(is_url_alive(img) for img in next_images))
+    for img, ok in zip(next_images, alive):
+        if not ok:
+            logging.info("skipping dead url %s", img)
+    next_images = [img for img, ok in zip(next_images, alive) if ok]
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="Показать ещё", callback_data="more")]]
-    )
+    shown = await send_photos(user_id, next_images)
+    if shown:
+        _spawn(asyncio.to_thread(_db_add_shown, user_id, shown))
+
+    # HEAD-проверка и отправка могли сократить блок — пишем, сколько дошло на самом деле
+    if shown:
+        text, markup = f"Показано изображений: {len(shown)}. Хочешь ещё?", MORE_KB
+    elif not next_images and not state.fetch_exhausted:
+        # очередь просто не успела наполниться — загрузчик ещё работает, кнопку оставляем
+        text, markup = "⏳ Картинки ещё загружаются. Нажми «Показать ещё» чуть позже.", MORE_KB
+    else:
+        text, markup = "❌ Не удалось показать изображения. Попробуй другой запрос.", None
 
     # обновляем текст сообщения, если вызвано callback'ом
     if call:
-        await call.message.edit_text("Показаны 5 изображений. Хочешь ещё?", reply_markup=keyboard)
+        try:
+            await call.message.edit_text(text, reply_markup=markup)
+        except TelegramBadRequest as e:
+            # текст и клавиатура те же, что были, — Telegram отвечает "message is not modified"
+            if "message is not modified" not in str(e):
+                raise
     else:
-        await bot.send_message(user_id, "Показаны 5 изображений. Хочешь ещё?", reply_markup=keyboard)
+        await bot.send_message(user_id, text, reply_markup=markup)
+
+
+async def start_session(user_id: int, query: str) -> bool:
+    images, bookmark = await search_pinterest(query)
+    if not images:
+        return False
+
+    # новый запрос — загрузчик и вкладка со старой выдачей больше не нужны
+    old_state = user_queries.get(user_id)
+    if old_state:
+        # дожидаемся отмены загрузчика, чтобы он не трогал вкладку, которую мы закрываем
+        old_state.fetcher.cancel()
+        await asyncio.gather(old_state.fetcher, return_exceptions=True)
+        await close_search_page(old_state)
+
+    # сначала показываем то, чего пользователь ещё не видел; если видел всё — идём по кругу
+    fresh = await asyncio.to_thread(_db_filter_unseen, user_id, images)
+
+    state = UserState(
+        # тот же ключ, по которому search_pinterest получил первую страницу и bookmark
+        query=normalize_query(query),
+        images=list(images),
+        queue=deque(fresh or images),
+        seen=set(images),
+        bookmark=bookmark
+    )
+    user_queries[user_id] = state
+    state.fetcher = _spawn(fetcher_loop(user_id))
+    return True
+
+
+async def _run_search(user_id: int, query: str):
+    async with _lock(user_id):
+        _spawn(asyncio.to_thread(_db_add_history, user_id, query))
+
+        if not await start_session(user_id, query):
+            await bot.send_message(user_id, "❌ Ничего не найдено. Попробуй другой запрос.")
+            return
+
+        await send_next_images(user_id)
+
+
+async def _run_more(user_id: int, call: CallbackQuery):
+    async with _lock(user_id):
+        # после перезапуска бота состояния в памяти нет — поднимаем последний запрос из истории
+        if user_id not in user_queries:
+            query = await asyncio.to_thread(_db_last_query, user_id)
+            if not query or not await start_session(user_id, query):
+                await bot.send_message(user_id, "Введи запрос — я пришлю картинки из Pinterest 📸")
+                return
+
+        await send_next_images(user_id, call=call)
 
 
 @router.message()
 async def get_images(message: Message):
     query = message.text.strip()
     await message.answer("Ищу изображения... 🔍")
-
-    images = await search_pinterest(query)
-
-    if not images:
-        await message.answer("❌ Ничего не найдено. Попробуй другой запрос.")
-        return
-
-    user_queries[message.from_user.id] = {"query": query, "images": images, "offset": 0}
-    await send_next_images(message.from_user.id)
+    # скрейпинг и отправка идут в фоне, чтобы не держать обработчик
+    _spawn(_run_search(message.from_user.id, query))
 
 
-@router.callback_query(lambda c: c.data == "more")
+@router.callback_query(F.data == "more")
 async def more_callback(callback: CallbackQuery):
-    await send_next_images(callback.from_user.id, call=callback)
     await callback.answer()
+    _spawn(_run_more(callback.from_user.id, callback))
+
+
+dp.startup.register(get_session)
 
 
 async def main():
+    log_listener = setup_logging()
+    _db_open()
+    await start_browser()
+    sweeper = asyncio.create_task(sweep_db_periodically())
+    session_reaper = asyncio.create_task(close_idle_sessions_periodically())
     print("Бот запущен!")
-    await dp.start_polling(bot)
+    try:
+        # длинный long-polling и только нужные типы апдейтов
+        await dp.start_polling(
+            bot,
+            polling_timeout=30,
+            handle_signals=True,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    finally:
+        # сначала гасим загрузчики и фоновые задачи — иначе они могут заново открыть
+        # HTTP-сессию или полезть в уже закрытую БД
+        tasks = [sweeper, session_reaper, *_background_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_session()
+        await stop_browser()
+        _db_close()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop быстрее стандартного цикла; на Windows его нет — тогда работаем на обычном
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
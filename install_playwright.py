@@ -1,7 +1,8 @@
 import subprocess
 
 try:
-    subprocess.run(["playwright", "install", "--with-deps"], check=True)
+    # боту нужен только Chromium — Firefox и WebKit не качаем
+    subprocess.run(["playwright", "install", "--with-deps", "chromium"], check=True)
     print("Playwright browsers installed")
 except Exception as e:
     print("Playwright setup failed:", e)